@@ -0,0 +1,902 @@
+"""Color, clipboard and queueing helpers for Fairy Color Picker
+
+Nothing here imports Tk, win32 or the hotkey/tray libraries, so these pieces
+load and run on a headless machine.
+"""
+import collections
+from datetime import datetime
+import functools
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+
+import numpy as np
+from PIL import ImageGrab
+
+class LatencyTracker:
+    """Keeps a rolling window of latency samples (in seconds)"""
+    def __init__(self, maxlen=200):
+        self.samples = collections.deque(maxlen=maxlen)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def stats(self):
+        # Report in milliseconds over the rolling window
+        if not self.samples:
+            return {'count': self.count, 'last_ms': 0.0, 'mean_ms': 0.0, 'min_ms': 0.0, 'max_ms': 0.0}
+        values = list(self.samples)
+        return {
+            'count': self.count,
+            'last_ms': values[-1] * 1000,
+            'mean_ms': sum(values) / len(values) * 1000,
+            'min_ms': min(values) * 1000,
+            'max_ms': max(values) * 1000
+        }
+
+class CommandQueue:
+    """Bounded queue used to run hotkey and tray callbacks on the Tk main loop"""
+    def __init__(self, maxsize=16, on_error=None):
+        self.maxsize = maxsize
+        self.on_error = on_error  # Called with sys.exc_info() when a command raises
+        self.pending = collections.OrderedDict()  # key -> (callback, args, enqueue time)
+        self.lock = threading.Lock()
+        self.latency = LatencyTracker()
+        self.collapsed = 0
+        self.dropped = 0
+        self.last_error = None
+
+    def post(self, key, callback, *args):
+        # Safe to call from any thread; returns False if the command was merged or dropped
+        with self.lock:
+            if key in self.pending:
+                # Collapse duplicates: keep the original slot and enqueue time, use the latest args
+                enqueued = self.pending[key][2]
+                self.pending[key] = (callback, args, enqueued)
+                self.collapsed += 1
+                return False
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.pending[key] = (callback, args, time.perf_counter())
+            return True
+
+    def drain(self):
+        # Must be called from the Tk main loop
+        with self.lock:
+            commands = list(self.pending.values())
+            self.pending.clear()
+        for callback, args, enqueued in commands:
+            self.latency.add(time.perf_counter() - enqueued)
+            try:
+                callback(*args)
+            except Exception as e:
+                # One failing command must not starve the rest of the batch
+                self.last_error = e
+                if self.on_error is not None:
+                    self.on_error(*sys.exc_info())
+                else:
+                    traceback.print_exc()
+        return len(commands)
+
+    def stats(self):
+        stats = self.latency.stats()
+        stats.update(collapsed=self.collapsed, dropped=self.dropped)
+        return stats
+
+def color_formats(r, g, b):
+    """Text representations published together on every copy"""
+    hex_color = f"#{r:02x}{g:02x}{b:02x}"
+    return {
+        'hex': hex_color,
+        'rgb': f"rgb({r}, {g}, {b})",
+        'values': f"{r}, {g}, {b}",
+        'css': f"--picked-color: {hex_color};"
+    }
+
+class MemoryClipboardBackend:
+    """Keeps clipboard contents in memory, for running without a display"""
+    blocking = False
+
+    def __init__(self):
+        self.text = ""
+        self.formats = {}
+
+    def publish(self, text, formats):
+        self.text = text
+        self.formats = dict(formats)
+
+class PyperclipBackend:
+    """pyperclip may spawn xclip/xsel on every copy, so it is run off the UI thread"""
+    blocking = True
+
+    def publish(self, text, formats):
+        # Imported on first use: the fallback is rarely needed and pyperclip is
+        # optional on machines where the Tk clipboard works
+        import pyperclip
+        pyperclip.copy(text)
+
+class ClipboardService:
+    """Publishes color formats through a clipboard backend and tracks copy latency"""
+    def __init__(self, backend, fallback=None):
+        self.backend = backend
+        self.fallback = fallback  # Used from then on if the backend fails
+        self.text = ""
+        self.formats = {}
+        self.latency = LatencyTracker()
+        self.pending = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.start_worker()
+
+    def start_worker(self):
+        if self.backend.blocking and self.worker is None:
+            self.worker = threading.Thread(target=self.run_worker, daemon=True)
+            self.worker.start()
+
+    def copy(self, text, formats=None):
+        self.text = text
+        self.formats = dict(formats or {})
+        request = (text, self.formats, time.perf_counter())
+        if not self.backend.blocking:
+            try:
+                self.publish(*request)
+                return
+            except Exception:
+                if self.fallback is None:
+                    raise
+                self.backend = self.fallback
+                self.fallback = None
+                self.start_worker()
+        if not self.backend.blocking:
+            self.publish(*request)
+        else:
+            # Only the most recent copy matters, older pending ones are replaced
+            with self.lock:
+                self.pending = request
+            self.wakeup.set()
+
+    def copy_formats(self, formats, primary='hex'):
+        self.copy(formats[primary], formats)
+
+    def publish(self, text, formats, requested):
+        self.backend.publish(text, formats)
+        self.latency.add(time.perf_counter() - requested)
+
+    def run_worker(self):
+        while True:
+            self.wakeup.wait()
+            with self.lock:
+                request = self.pending
+                self.pending = None
+                self.wakeup.clear()
+            if request is None:
+                continue
+            try:
+                self.publish(*request)
+            except Exception:
+                pass  # Clipboard helpers can fail transiently, the next copy retries
+
+def srgb_to_lab(rgb):
+    """Convert sRGB values (0-255, any leading shape) to CIE Lab under D65"""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = linear @ np.array([[0.4124564, 0.2126729, 0.0193339],
+                             [0.3575761, 0.7151522, 0.1191920],
+                             [0.1804375, 0.0721750, 0.9503041]])
+    xyz = xyz / np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16,
+                     500 * (f[..., 0] - f[..., 1]),
+                     200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def delta_e_2000(lab1, lab2):
+    """CIEDE2000 color difference, broadcasting over the leading dimensions"""
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    
+    # Rescale a* so neutral colors get the right weight
+    c_mean7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2) ** 7
+    g = 0.5 * (1 - np.sqrt(c_mean7 / (c_mean7 + 25.0 ** 7)))
+    a1p = a1 * (1 + g)
+    a2p = a2 * (1 + g)
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+    achromatic = c1p * c2p == 0
+    
+    # Lightness, chroma and hue differences
+    dLp = L2 - L1
+    dCp = c2p - c1p
+    dh = h2p - h1p
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+    dh = np.where(achromatic, 0, dh)
+    dHp = 2 * np.sqrt(c1p * c2p) * np.sin(np.radians(dh) / 2)
+    
+    # Means used by the weighting functions (hue mean on the shortest arc)
+    Lp = (L1 + L2) / 2
+    Cp = (c1p + c2p) / 2
+    h_sum = h1p + h2p
+    hp = np.where(np.abs(h1p - h2p) > 180,
+                  np.where(h_sum < 360, h_sum + 360, h_sum - 360), h_sum) / 2
+    hp = np.where(achromatic, h_sum, hp)
+    
+    t = (1 - 0.17 * np.cos(np.radians(hp - 30)) + 0.24 * np.cos(np.radians(2 * hp))
+         + 0.32 * np.cos(np.radians(3 * hp + 6)) - 0.20 * np.cos(np.radians(4 * hp - 63)))
+    d_theta = 30 * np.exp(-((hp - 275) / 25) ** 2)
+    cp7 = Cp ** 7
+    rt = -np.sin(np.radians(2 * d_theta)) * 2 * np.sqrt(cp7 / (cp7 + 25.0 ** 7))
+    sl = 1 + 0.015 * (Lp - 50) ** 2 / np.sqrt(20 + (Lp - 50) ** 2)
+    sc = 1 + 0.045 * Cp
+    sh = 1 + 0.015 * Cp * t
+    
+    return np.sqrt((dLp / sl) ** 2 + (dCp / sc) ** 2 + (dHp / sh) ** 2
+                   + rt * (dCp / sc) * (dHp / sh))
+
+# ΔE2000 is at least |ΔL| / S_L and S_L never exceeds 1.75
+LIGHTNESS_SPREAD = 1.75
+
+# After compressing chroma like ΔE2000's S_C does, two sRGB colors closer than a
+# given ΔE2000 stay within this many times that distance on the a*b* plane.
+# The blue hues where ΔE2000's rotation term acts need more room (measured
+# maximum about 2.4 there, 1.2 elsewhere)
+CHROMA_SPREAD = 3.0
+CHROMA_SPREAD_OUTSIDE_BLUE = 1.5
+BLUE_HUES = (200.0, 350.0)
+
+def chroma_spread(lab):
+    hue = np.degrees(np.arctan2(lab[..., 2], lab[..., 1])) % 360
+    return np.where((hue >= BLUE_HUES[0]) & (hue <= BLUE_HUES[1]), CHROMA_SPREAD, CHROMA_SPREAD_OUTSIDE_BLUE)
+
+def lab_grid_coords(lab):
+    """Lab with chroma scaled to ln(1 + 0.045 C) / 0.045, which keeps ΔE2000 neighbours close"""
+    lab = np.asarray(lab, dtype=np.float64)
+    chroma = np.hypot(lab[..., 1], lab[..., 2])
+    scale = np.log1p(0.045 * chroma) / (0.045 * np.maximum(chroma, 1e-9))
+    return np.stack([lab[..., 0], lab[..., 1] * scale, lab[..., 2] * scale], axis=-1)
+
+NEIGHBOUR_CELLS = [(dx, dy, dz) for dx in range(-2, 3) for dy in range(-2, 3) for dz in range(-2, 3)]
+# Enough when the a*b* reach is at most one cell
+NARROW_NEIGHBOUR_CELLS = [(dx, dy, dz) for dx in range(-2, 3) for dy in range(-1, 2) for dz in range(-1, 2)]
+
+class LabGridIndex:
+    """Buckets colors on a Lab grid so ΔE2000 lookups only scan neighbouring cells"""
+    def __init__(self, threshold=2.3):
+        if not 0 < threshold < float('inf'):
+            raise ValueError(f"ΔE2000 threshold must be positive and finite, got {threshold}")
+        self.threshold = threshold
+        # Cells are half the search reach on each axis, so a lookup scans a 5x5x5 block
+        self.lightness_reach = threshold * LIGHTNESS_SPREAD
+        self.reach = threshold * CHROMA_SPREAD
+        self.cell_size = np.array([self.lightness_reach, self.reach, self.reach]) / 2
+        self.lab = np.empty((64, 3))
+        self.coords = np.empty((64, 3))  # lab_grid_coords of each slot
+        self.keys = []  # slot -> key
+        self.slots = {}  # key -> slot
+        self.free = []
+        self.cells = {}  # cell -> array of slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def cell_of(self, coords):
+        return tuple(np.floor(coords / self.cell_size).astype(int).tolist())
+
+    def reserve(self, count):
+        if count > len(self.lab):
+            # Grow geometrically so inserts stay amortized O(1)
+            size = max(count, 2 * len(self.lab))
+            for name in ('lab', 'coords'):
+                grown = np.empty((size, 3))
+                grown[:len(self.keys)] = getattr(self, name)[:len(self.keys)]
+                setattr(self, name, grown)
+
+    def add(self, key, rgb):
+        self.add_lab(key, srgb_to_lab(rgb))
+
+    def add_lab(self, key, lab):
+        if key in self.slots:
+            self.remove(key)
+        if self.free:
+            slot = self.free.pop()
+            self.keys[slot] = key
+        else:
+            slot = len(self.keys)
+            self.reserve(slot + 1)
+            self.keys.append(key)
+        self.lab[slot] = lab
+        self.coords[slot] = lab_grid_coords(lab)
+        self.slots[key] = slot
+        cell = self.cell_of(self.coords[slot])
+        members = self.cells.get(cell)
+        self.cells[cell] = np.array([slot]) if members is None else np.append(members, slot)
+
+    def add_many(self, keys, rgbs):
+        """Bulk insert with one vectorized Lab conversion; later duplicate keys win"""
+        latest = {}
+        for i, key in enumerate(keys):
+            latest[key] = i
+        for key in latest:
+            self.remove(key)
+        order = np.fromiter(latest.values(), dtype=np.intp, count=len(latest))
+        if not len(order):
+            return
+        lab = srgb_to_lab(np.asarray(rgbs).reshape(-1, 3)[order])
+        first = len(self.keys)
+        slots = np.arange(first, first + len(order))
+        self.reserve(first + len(order))
+        self.lab[slots] = lab
+        self.coords[slots] = lab_grid_coords(lab)
+        self.keys.extend(latest)
+        self.slots.update(zip(latest, slots.tolist()))
+        
+        # Group the new slots by cell with a single sort
+        cells = np.floor(self.coords[slots] / self.cell_size).astype(int)
+        by_cell = np.lexsort(cells.T[::-1])
+        cells, slots = cells[by_cell], slots[by_cell]
+        starts = np.flatnonzero(np.any(np.diff(cells, axis=0) != 0, axis=1)) + 1
+        for cell, members in zip(map(tuple, cells[np.r_[0, starts]].tolist()), np.split(slots, starts)):
+            existing = self.cells.get(cell)
+            self.cells[cell] = members if existing is None else np.concatenate([existing, members])
+
+    def remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        cell = self.cell_of(self.coords[slot])
+        members = self.cells[cell][self.cells[cell] != slot]
+        if len(members):
+            self.cells[cell] = members
+        else:
+            del self.cells[cell]
+        self.keys[slot] = None
+        self.free.append(slot)
+
+    def neighbour_slots(self, cell, offsets=NEIGHBOUR_CELLS):
+        cx, cy, cz = cell
+        parts = [self.cells[c] for c in ((cx + dx, cy + dy, cz + dz) for dx, dy, dz in offsets)
+                 if c in self.cells]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.intp)
+
+    def within_reach(self, offsets, reach, lightness):
+        # Cheap prefilter before the full ΔE2000 formula: the exact |ΔL| / S_L
+        # bound on lightness, a cylinder on the compressed a*b* plane
+        mean_lightness = lightness + offsets[..., 0] / 2 - 50
+        weight = 1 + 0.015 * mean_lightness ** 2 / np.sqrt(20 + mean_lightness ** 2)
+        return ((np.abs(offsets[..., 0]) <= self.threshold * weight)
+                & (offsets[..., 1] ** 2 + offsets[..., 2] ** 2 <= reach ** 2))
+
+    def find(self, rgb):
+        """Return the key of the closest color within the threshold, or None"""
+        return self.find_lab(srgb_to_lab(rgb))
+
+    def merge(self, key, rgb):
+        """Insert a color in place of the closest one within the threshold, returning that key"""
+        lab = srgb_to_lab(rgb)
+        match = self.find_lab(lab)
+        if match is not None:
+            self.remove(match)
+        self.add_lab(key, lab)
+        return match
+
+    def find_lab(self, lab):
+        coords = lab_grid_coords(lab)
+        reach = self.threshold * chroma_spread(lab)
+        offsets = NEIGHBOUR_CELLS if reach > self.cell_size[1] else NARROW_NEIGHBOUR_CELLS
+        candidates = self.neighbour_slots(self.cell_of(coords), offsets)
+        candidates = candidates[self.within_reach(self.coords[candidates] - coords, reach, lab[0])]
+        if not len(candidates):
+            return None
+        distances = delta_e_2000(lab, self.lab[candidates])
+        best = int(np.argmin(distances))
+        if distances[best] > self.threshold:
+            return None
+        return self.keys[candidates[best]]
+
+def entry_rgb(item):
+    if 'rgb' in item:
+        return tuple(item['rgb'])
+    # Convert hex to rgb for older history entries
+    hex_color = item['color'].lstrip('#')
+    return (int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16))
+
+def collapse_near_duplicates(history, threshold=2.3, budget=250000):
+    """Drop entries within the ΔE2000 threshold of a newer kept entry"""
+    if len(history) < 2:
+        return list(history)
+    # Slots equal history positions in a freshly built index
+    index = LabGridIndex(threshold)
+    index.add_many(range(len(history)), [entry_rgb(item) for item in history])
+    lab = index.lab[:len(history)]
+    coords = index.coords[:len(history)]
+    
+    # Collect every (older, newer) near-duplicate pair, one cell block at a time
+    older, newer = [], []
+    for cell, members in index.cells.items():
+        neighbours = index.neighbour_slots(cell)
+        chunk = max(1, budget // len(neighbours))
+        for start in range(0, len(members), chunk):
+            block = members[start:start + chunk]
+            close = neighbours[None, :] > block[:, None]
+            reach = threshold * chroma_spread(lab[block])[:, None]
+            close &= index.within_reach(coords[neighbours][None, :, :] - coords[block][:, None, :],
+                                        reach, lab[block, 0][:, None])
+            rows, cols = np.nonzero(close)
+            rows, cols = block[rows], neighbours[cols]
+            close = delta_e_2000(lab[rows], lab[cols]) <= threshold
+            older.append(rows[close].astype(np.int32))
+            newer.append(cols[close].astype(np.int32))
+    older = np.concatenate(older)
+    newer = np.concatenate(newer)
+    
+    # CSR layout: the newer duplicates of entry i are newer[bounds[i]:bounds[i + 1]]
+    by_older = np.argsort(older, kind='stable')
+    older, newer = older[by_older], newer[by_older]
+    bounds = np.searchsorted(older, np.arange(len(history) + 1))
+    
+    # History is oldest first, so sweep backwards keeping the newest of each cluster;
+    # entries without newer duplicates are always kept
+    keep = np.ones(len(history), dtype=bool)
+    for i in np.unique(older)[::-1].tolist():
+        if keep[newer[bounds[i]:bounds[i + 1]]].any():
+            keep[i] = False
+    return [item for item, kept in zip(history, keep) if kept]
+
+class HistoryPositions:
+    """Finds history entries by HEX without scanning the whole list"""
+    def __init__(self, history, slack=256):
+        self.history = history
+        self.slack = slack
+        self.rebuild()
+
+    def rebuild(self):
+        self.positions = {item["color"]: i for i, item in enumerate(self.history)}
+        self.removals = 0
+
+    def find(self, hex_color):
+        position = self.positions.get(hex_color)
+        if position is None:
+            return None
+        # Each removal since the position was recorded shifts it left by at most one
+        for i in range(min(position, len(self.history) - 1), max(position - self.removals, 0) - 1, -1):
+            if self.history[i]["color"] == hex_color:
+                return i
+        return None
+
+    def pop(self, i):
+        item = self.history.pop(i)
+        self.positions.pop(item["color"], None)
+        self.removals += 1
+        if self.removals > self.slack:
+            self.rebuild()
+        return item
+
+    def append(self, item):
+        self.positions[item["color"]] = len(self.history)
+        self.history.append(item)
+
+class ScreenFrameSource:
+    """Captures a screen rectangle (left, top, right, bottom) as an RGB array"""
+    def __init__(self, bbox):
+        self.bbox = bbox
+
+    def grab(self):
+        return np.asarray(ImageGrab.grab(bbox=self.bbox).convert('RGB'))
+
+class SyntheticFrameSource:
+    """Replays generated frames so a RegionWatcher can run without a screen"""
+    def __init__(self, frames):
+        self.frames = iter(frames)
+        self.frame = None
+
+    def grab(self):
+        # Keep returning the last frame once the sequence is exhausted
+        self.frame = np.asarray(next(self.frames, self.frame))
+        return self.frame
+
+class RegionWatcher:
+    """Samples a screen region at an adaptive rate and reports averaged color changes"""
+    def __init__(self, source, on_change, threshold=2.3, min_interval=0.1, max_interval=2.0, backoff=1.5):
+        self.source = source
+        self.on_change = on_change
+        self.threshold = threshold  # ΔE2000 between averaged colors
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.previous = None  # Last captured frame
+        self.color = None  # Last reported averaged color
+        self.samples = 0
+        self.changes = 0
+        self.cpu_time = 0.0
+        self.started = None
+        self.intervals = LatencyTracker()
+        self.last_error = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def step(self):
+        cpu_start = time.thread_time()
+        frame = self.source.grab()
+        self.samples += 1
+        changed = False
+        if self.previous is None or frame.shape != self.previous.shape:
+            active = True
+        else:
+            # Identical captures are the common case and skip averaging entirely
+            active = not np.array_equal(frame, self.previous)
+        if active:
+            color = frame.reshape(-1, frame.shape[-1])[:, :3].mean(axis=0)
+            if self.color is None:
+                self.color = color  # Baseline, not a change
+            elif delta_e_2000(srgb_to_lab(color), srgb_to_lab(self.color)) > self.threshold:
+                self.color = color
+                changed = True
+        self.previous = frame
+        
+        # Sample fast right after a change, slow down while the region is static
+        if changed:
+            self.interval = self.min_interval
+        elif not active:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        self.cpu_time += time.thread_time() - cpu_start
+        
+        if changed:
+            self.changes += 1
+            # A capture that finishes after stop() is not reported
+            if not self.stop_event.is_set():
+                self.on_change(tuple(int(round(c)) for c in self.color), datetime.now())
+        return changed
+
+    def run(self):
+        last = None
+        while not self.stop_event.is_set():
+            now = time.perf_counter()
+            if last is not None:
+                self.intervals.add(now - last)
+            last = now
+            try:
+                self.step()
+            except Exception as e:
+                self.last_error = e
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.stop_event.clear()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        intervals = self.intervals.stats()
+        return {
+            'samples': self.samples,
+            'changes': self.changes,
+            'cpu_percent': self.cpu_time / elapsed * 100 if elapsed else 0.0,
+            'interval_ms': self.interval * 1000,
+            'mean_interval_ms': intervals['mean_ms'],
+            'min_interval_ms': intervals['min_ms'],
+            'max_interval_ms': intervals['max_ms']
+        }
+
+def srgb_to_linear(rgb):
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    return np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(linear):
+    linear = np.clip(linear, 0.0, 1.0)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055) * 255.0
+
+def linear_to_oklab(linear):
+    lms = np.cbrt(linear @ np.array([[0.4122214708, 0.2119034982, 0.0883024619],
+                                     [0.5363325363, 0.6806995451, 0.2817188376],
+                                     [0.0514459929, 0.1073969566, 0.6299787005]]))
+    return lms @ np.array([[0.2104542553, 1.9779984951, 0.0259040371],
+                           [0.7936177850, -2.4285922050, 0.7827717662],
+                           [-0.0040720468, 0.4505937099, -0.8086757660]])
+
+def oklab_to_linear(lab):
+    lms = (lab @ np.array([[1.0, 1.0, 1.0],
+                           [0.3963377774, -0.1055613458, -0.0894841775],
+                           [0.2158037573, -0.0638541728, -1.2914855480]])) ** 3
+    return lms @ np.array([[4.0767416621, -1.2684380046, -0.0041960863],
+                           [-3.3077115913, 2.6097574011, -0.7034186147],
+                           [0.2309699292, -0.3413193965, 1.7076147010]])
+
+def rgb_to_hsv_array(rgb):
+    """Vectorized colorsys.rgb_to_hsv for (..., 3) arrays in 0-255"""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    v = rgb.max(axis=-1)
+    delta = v - rgb.min(axis=-1)
+    s = np.where(v > 0, delta / np.where(v > 0, v, 1), 0)
+    safe = np.where(delta > 0, delta, 1)
+    h = np.where(v == r, (g - b) / safe, np.where(v == g, 2 + (b - r) / safe, 4 + (r - g) / safe))
+    h = np.where(delta > 0, (h / 6) % 1.0, 0)
+    return np.stack([h, s, v], axis=-1)
+
+def hsv_to_rgb_array(hsv):
+    """Vectorized colorsys.hsv_to_rgb returning (..., 3) arrays in 0-255"""
+    h, s, v = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    i = np.floor(h * 6).astype(int) % 6
+    f = h * 6 - np.floor(h * 6)
+    p = v * (1 - s)
+    q = v * (1 - s * f)
+    t = v * (1 - s * (1 - f))
+    choices = [np.stack(c, axis=-1) for c in ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))]
+    return np.choose(i[..., None], choices) * 255.0
+
+GRADIENT_SPACES = ['srgb', 'linear', 'oklab', 'hsv']
+# The gradient dialog previews one swatch per step
+MAX_GRADIENT_STEPS = 100
+
+def gradient_colors(colors, positions, space='oklab'):
+    """Sample a gradient through evenly spaced color stops at positions in [0, 1]
+
+    Returns float RGB values in 0-255 with shape (len(positions), 3).
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    positions = np.clip(np.asarray(positions, dtype=np.float64), 0.0, 1.0)
+    if len(colors) == 1:
+        return np.repeat(colors, len(positions), axis=0)
+    
+    # Locate the segment each position falls into and the offset inside it
+    scaled = positions * (len(colors) - 1)
+    segment = np.minimum(scaled.astype(int), len(colors) - 2)
+    t = (scaled - segment)[:, None]
+    
+    if space == 'srgb':
+        stops = colors
+    elif space == 'linear':
+        stops = srgb_to_linear(colors)
+    elif space == 'oklab':
+        stops = linear_to_oklab(srgb_to_linear(colors))
+    elif space == 'hsv':
+        stops = rgb_to_hsv_array(colors)
+    else:
+        raise ValueError(f"Unknown gradient space: {space}")
+    
+    start, end = stops[segment], stops[segment + 1]
+    mixed = start + (end - start) * t
+    if space == 'hsv':
+        # Interpolate hue along the shortest arc of the color wheel
+        hue_delta = (end[:, 0] - start[:, 0] + 0.5) % 1.0 - 0.5
+        mixed[:, 0] = (start[:, 0] + hue_delta * t[:, 0]) % 1.0
+        return hsv_to_rgb_array(mixed)
+    if space == 'linear':
+        return linear_to_srgb(mixed)
+    if space == 'oklab':
+        return linear_to_srgb(oklab_to_linear(mixed))
+    return mixed
+
+def gradient_stops(colors, steps, space='oklab'):
+    """N evenly spaced gradient colors as integer RGB tuples"""
+    values = np.rint(gradient_colors(colors, np.linspace(0.0, 1.0, steps), space))
+    return [tuple(int(c) for c in color) for color in np.clip(values, 0, 255)]
+
+def bayer_matrix(size=8):
+    matrix = np.zeros((1, 1), dtype=int)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+def blue_noise_tile(size=64, seed=0, iterations=4):
+    """Approximate blue noise ranks by repeatedly high-pass filtering white noise"""
+    rng = np.random.default_rng(seed)
+    noise = rng.random((size, size))
+    freq = np.fft.fftfreq(size)
+    radius2 = freq[:, None] ** 2 + freq[None, :] ** 2
+    lowpass = np.exp(-radius2 / (2 * 0.08 ** 2))
+    for _ in range(iterations):
+        noise = noise - np.real(np.fft.ifft2(np.fft.fft2(noise) * lowpass))
+        # Re-rank so thresholds stay uniformly distributed
+        noise = np.argsort(np.argsort(noise, axis=None)).reshape(size, size) / (size * size)
+    return (noise * size * size).astype(int)
+
+def dither_thresholds(method):
+    """Threshold tile in (0, 1) for ordered dithering, or None for plain rounding"""
+    if method in (None, 'none'):
+        return None
+    if method == 'ordered':
+        ranks = bayer_matrix(8)
+    elif method == 'blue-noise':
+        ranks = blue_noise_tile(64)
+    else:
+        raise ValueError(f"Unknown dither method: {method}")
+    return (ranks + 0.5) / ranks.size
+
+def gradient_row_blocks(colors, width, height, space='oklab', dither='ordered', block_rows=64):
+    """Yield the rows of a horizontal gradient image as uint8 blocks of at most block_rows"""
+    row = gradient_colors(colors, np.linspace(0.0, 1.0, width), space)
+    thresholds = dither_thresholds(dither)
+    for top in range(0, height, block_rows):
+        rows = min(block_rows, height - top)
+        if thresholds is None:
+            block = np.broadcast_to(np.rint(row), (rows, width, 3))
+        else:
+            # Tile the threshold map over this block only, so memory stays bounded
+            tile = len(thresholds)
+            ys = np.arange(top, top + rows) % tile
+            xs = np.arange(width) % tile
+            block = np.floor(row[None, :, :] + thresholds[ys[:, None], xs[None, :]][:, :, None])
+        yield np.clip(block, 0, 255).astype(np.uint8)
+
+def write_png_blocks(path, width, height, blocks):
+    """Stream RGB row blocks into a PNG file without holding the whole image"""
+    def chunk(f, kind, data):
+        f.write(struct.pack('>I', len(data)))
+        f.write(kind + data)
+        f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    
+    compressor = zlib.compressobj(6)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for block in blocks:
+            # Every scanline starts with filter type 0 (None)
+            scanlines = np.zeros((len(block), width * 3 + 1), dtype=np.uint8)
+            scanlines[:, 1:] = block.reshape(len(block), -1)
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', compressor.flush())
+        chunk(f, b'IEND', b'')
+
+def export_gradient_image(path, colors, width=7680, height=1080, space='oklab', dither='ordered',
+                          block_rows=64):
+    # Write next to the target and rename at the end, so an interrupted export
+    # never leaves a truncated PNG under the requested name
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, partial = tempfile.mkstemp(prefix=f".{name}.", suffix=".part", dir=directory)
+    os.close(fd)
+    try:
+        write_png_blocks(partial, width, height,
+                         gradient_row_blocks(colors, width, height, space, dither, block_rows))
+        os.replace(partial, path)
+    except BaseException:
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+
+def nearest_palette_index(pixels, palette, budget=4000000):
+    """Brute-force index of the nearest palette color (RGB distance) for (N, 3) pixels"""
+    pixels = np.asarray(pixels, dtype=np.float64).reshape(-1, 3)
+    palette = np.asarray(palette, dtype=np.float64)
+    palette_sq = (palette ** 2).sum(axis=1)
+    result = np.empty(len(pixels), dtype=np.intp)
+    # Bound the (pixels x palette) distance matrix held at once
+    chunk = max(1, budget // len(palette))
+    for start in range(0, len(pixels), chunk):
+        block = pixels[start:start + chunk]
+        # |p - c|^2 without the |p|^2 term, which doesn't change the argmin
+        result[start:start + chunk] = np.argmin(palette_sq[None, :] - 2 * block @ palette.T, axis=1)
+    return result
+
+@functools.lru_cache(maxsize=8)
+def build_palette_lut(palette_bytes, bits=5):
+    """Coarse RGB -> palette lookup table keyed by the palette contents
+
+    A cell whose 8 corners share the same nearest color stores that index,
+    which is exact because nearest-color regions are convex. Boundary cells
+    store -(row + 1) into a table of the only palette entries that can be
+    nearest somewhere inside the cell.
+    """
+    palette = np.frombuffer(palette_bytes, dtype=np.uint8).reshape(-1, 3)
+    cells = 1 << bits
+    step = 256 >> bits
+    low = np.arange(0, 256, step)
+    high = low + step - 1
+    # Nearest color at every cell corner (lowest and highest value per channel, interleaved)
+    corners = np.stack([low, high], axis=1).ravel()
+    grid = np.stack(np.meshgrid(corners, corners, corners, indexing='ij'), axis=-1)
+    nearest = nearest_palette_index(grid.reshape(-1, 3), palette)
+    nearest = nearest.reshape(cells, 2, cells, 2, cells, 2).transpose(0, 2, 4, 1, 3, 5).reshape(cells, cells, cells, 8)
+    unanimous = (nearest == nearest[..., :1]).all(axis=-1)
+    lut = np.where(unanimous, nearest[..., 0], -1).astype(np.int32)
+    
+    # Per-channel squared distance from each cell range to each palette value
+    values = palette.astype(np.int64).T[:, None, :]  # (3, 1, P)
+    near = np.maximum(np.maximum(low[None, :, None] - values, values - high[None, :, None]), 0) ** 2
+    far = np.maximum(np.abs(values - low[None, :, None]), np.abs(values - high[None, :, None])) ** 2
+    
+    # A color can only win inside a cell if its closest point there beats the
+    # best worst-case distance of any color
+    boundary = np.argwhere(~unanimous)
+    candidates = []
+    for start in range(0, len(boundary), 1024):
+        i, j, k = boundary[start:start + 1024].T
+        near_d = near[0, i] + near[1, j] + near[2, k]
+        far_d = far[0, i] + far[1, j] + far[2, k]
+        candidates.extend(np.flatnonzero(row) for row in near_d <= far_d.min(axis=1, keepdims=True))
+    width = max((len(c) for c in candidates), default=1)
+    table = np.empty((len(candidates), width), dtype=np.intp)
+    for row, entries in enumerate(candidates):
+        # Pad with the first entry so argmin still picks the lowest index on ties
+        table[row, :len(entries)] = entries
+        table[row, len(entries):] = entries[0]
+    lut[tuple(boundary.T)] = -np.arange(1, len(boundary) + 1)
+    lut.setflags(write=False)
+    table.setflags(write=False)
+    return lut, table
+
+class PaletteQuantizer:
+    """Maps images onto a fixed palette through a cached lookup table"""
+    def __init__(self, palette, bits=5):
+        self.palette = np.unique(np.asarray(palette, dtype=np.uint8).reshape(-1, 3), axis=0)
+        self.bits = bits
+        self.lut, self.candidates = build_palette_lut(self.palette.tobytes(), bits)
+
+    def lookup(self, pixels):
+        # pixels: (N, 3) uint8
+        shift = 8 - self.bits
+        indices = self.lut[pixels[:, 0] >> shift, pixels[:, 1] >> shift, pixels[:, 2] >> shift].astype(np.intp)
+        boundary = indices < 0
+        if boundary.any():
+            # Exact refinement against the few candidates of each boundary cell
+            candidates = self.candidates[-indices[boundary] - 1]
+            diff = pixels[boundary][:, None, :].astype(np.int32) - self.palette[candidates].astype(np.int32)
+            best = np.argmin((diff * diff).sum(axis=-1), axis=1)
+            indices[boundary] = candidates[np.arange(len(candidates)), best]
+        return indices
+
+    def indices(self, image, dither=False, chunk_rows=64):
+        """Palette index for every pixel of an (H, W, 3) image"""
+        image = np.asarray(image)[..., :3]
+        height, width = image.shape[:2]
+        result = np.empty((height, width), dtype=np.intp)
+        if not dither:
+            for top in range(0, height, chunk_rows):
+                block = np.ascontiguousarray(image[top:top + chunk_rows], dtype=np.uint8)
+                result[top:top + len(block)] = self.lookup(block.reshape(-1, 3)).reshape(len(block), width)
+            return result
+        
+        # Floyd-Steinberg error diffusion. Pixel (y, x) only depends on (y, x - 1)
+        # and (y - 1, x - 1 .. x + 1), so every pixel on the wavefront x + 2y = t
+        # can be quantized at once. Bands of rows bound the float work buffer; the
+        # extra last row collects the error passed down to the next band
+        palette = self.palette.astype(np.float32)
+        band_rows = 4 * chunk_rows
+        carry = np.zeros((width, 3), dtype=np.float32)
+        for top in range(0, height, band_rows):
+            rows = min(band_rows, height - top)
+            work = np.zeros((rows + 1, width, 3), dtype=np.float32)
+            work[:rows] = image[top:top + rows]
+            work[0] += carry
+            for t in range(width + 2 * (rows - 1)):
+                ys = np.arange(max(0, (t - width + 2) // 2), min(rows - 1, t // 2) + 1)
+                if not len(ys):
+                    continue  # Odd wavefronts of a one pixel wide image are empty
+                xs = t - 2 * ys
+                values = np.clip(work[ys, xs], 0, 255)
+                nearest = self.lookup(np.rint(values).astype(np.uint8))
+                result[top + ys, xs] = nearest
+                error = values - palette[nearest]
+                # Only the first pixel can sit on the right edge and only the last on the left
+                right = slice(1, None) if xs[0] == width - 1 else slice(None)
+                left = slice(None, -1) if xs[-1] == 0 else slice(None)
+                work[ys[right], xs[right] + 1] += error[right] * (7 / 16)
+                work[ys[left] + 1, xs[left] - 1] += error[left] * (3 / 16)
+                work[ys + 1, xs] += error * (5 / 16)
+                work[ys[right] + 1, xs[right] + 1] += error[right] * (1 / 16)
+            carry = work[rows]
+        return result
+
+    def remap(self, image, dither=False, chunk_rows=64):
+        return self.palette[self.indices(image, dither, chunk_rows)]
@@ -1,5 +1,6 @@
 import customtkinter as ctk
-import pyperclip
+import tkinter
+import tkinter.filedialog
 from datetime import datetime
 import json
 import os
@@ -9,7 +10,6 @@ import re
 import pystray
 from PIL import Image, ImageGrab
 import threading
-import time
 import win32gui
 import win32con
 import sys
@@ -17,6 +17,10 @@ import tempfile
 import atexit
 import colorsys
 import numpy as np
+from color_core import (CommandQueue, color_formats, PyperclipBackend, ClipboardService,
+                        LabGridIndex, entry_rgb, collapse_near_duplicates, HistoryPositions,
+                        ScreenFrameSource, RegionWatcher, GRADIENT_SPACES, MAX_GRADIENT_STEPS,
+                        gradient_stops, export_gradient_image, PaletteQuantizer)
 
 def show_already_running_message():
     root = ctk.CTk()
@@ -90,6 +94,23 @@ def check_running_instance():
     except:
         return True  # If we can't create the lock file, still allow the app to run
 
+class TkClipboardBackend:
+    """Uses the Tk root as a long-lived clipboard owner instead of spawning a helper per copy"""
+    blocking = False
+
+    def __init__(self, widget):
+        self.widget = widget
+
+    def publish(self, text, formats):
+        self.widget.clipboard_clear()
+        self.widget.clipboard_append(text)
+        # Offer every format as its own target where the windowing system supports it
+        for name, value in formats.items():
+            try:
+                self.widget.clipboard_append(value, type=f"text/x-color-{name}")
+            except tkinter.TclError:
+                pass
+
 class ColorPicker(ctk.CTk):
     def __init__(self):
         super().__init__()
@@ -109,6 +130,10 @@ class ColorPicker(ctk.CTk):
         self.blue_var = ctk.IntVar(value=0)
         self.color_input_var = ctk.StringVar(value="")
         self.history = []
+        self.history_index = None  # Lab grid index, built on demand in perceptual mode
+        self.history_positions = None  # HEX -> position lookup, built on demand
+        self.history_version = 0  # Bumped on every history change
+        self.is_merging = False
         self.history_file = "color_history.json"
         self.config_file = "config.json"
         self.view_mode = ctk.StringVar(value="list")  # 'list' or 'grid'
@@ -126,6 +151,22 @@ class ColorPicker(ctk.CTk):
         # Window state tracking
         self.was_in_tray = False  # Track if window was in tray
         self.is_minimized = False
+        self.is_picking = False  # Only one screen pick at a time
+        self.watcher = None  # Active RegionWatcher, if any
+        
+        # Watched color changes are buffered apart from the command queue so a
+        # busy region can't crowd out user commands; they're flushed in batches
+        self.watch_events = []
+        self.watch_lock = threading.Lock()
+        
+        # Hotkey and tray callbacks run on foreign threads, so they are queued
+        # here and executed by the Tk main loop
+        self.commands = CommandQueue(on_error=self.report_callback_exception)
+        self.command_poll_ms = 30
+        
+        # The Tk root owns the clipboard for the lifetime of the app; if Tk can't
+        # reach the clipboard, copies move to pyperclip on a worker thread
+        self.clipboard_service = ClipboardService(TkClipboardBackend(self), fallback=PyperclipBackend())
         
         # System tray setup
         self.setup_system_tray()
@@ -137,13 +178,24 @@ class ColorPicker(ctk.CTk):
         self.create_widgets()
         self.load_history()
         self.set_initial_color()
+        self.after(self.command_poll_ms, self.process_commands)
+        
+    def process_commands(self):
+        try:
+            self.commands.drain()
+        finally:
+            self.after(self.command_poll_ms, self.process_commands)
+    
+    def post_command(self, key, callback, *args):
+        # Thread-safe entry point for hotkey and tray actions
+        return lambda *_: self.commands.post(key, callback, *args)
         
     def setup_system_tray(self):
         # Create a simple icon with the default color (red)
         self.icon_image = Image.new('RGB', (64, 64), color='red')
         
         def create_shortcut_handler(preset):
-            return lambda: self.change_shortcut(preset)
+            return self.post_command("shortcut", self.change_shortcut, preset)
             
         def create_shortcut_checker(preset):
             return lambda item: self.shortcut == preset
@@ -166,22 +218,70 @@ class ColorPicker(ctk.CTk):
             self.icon_image,
             "Fairy Color Picker",
             menu=pystray.Menu(
-                pystray.MenuItem("Pick Color", self.start_color_pick),
-                pystray.MenuItem("Show Window", self.show_window),
+                pystray.MenuItem("Pick Color", self.post_command("pick", self.start_color_pick)),
+                pystray.MenuItem("Show Window", self.post_command("show", self.show_window)),
+                pystray.MenuItem("Watch Region", self.post_command("watch", self.start_region_watch)),
+                pystray.MenuItem("Stop Watching", self.post_command("unwatch", self.stop_region_watch),
+                                 enabled=lambda item: self.watcher is not None),
                 pystray.MenuItem("Keyboard Shortcut", pystray.Menu(*shortcut_menu)),
-                pystray.MenuItem("Exit", self.quit_app)
+                pystray.MenuItem("Merge Similar Colors",
+                                 self.post_command("dedup", self.toggle_perceptual_dedup),
+                                 checked=lambda item: self.dedup_mode == 'perceptual'),
+                pystray.MenuItem("Exit", self.post_command("quit", self.quit_app))
             )
         )
         
         threading.Thread(target=self.icon.run, daemon=True).start()
 
     def setup_keyboard_shortcut(self):
-        keyboard.add_hotkey(self.shortcut, self.start_color_pick)
+        keyboard.add_hotkey(self.shortcut, self.post_command("pick", self.start_color_pick))
 
     def start_color_pick(self):
+        # Ignore repeated hotkeys while a pick is already in progress
+        if self.is_picking:
+            return
         # Don't show main window, directly start color picking
         self.pick_color_from_screen()
 
+    def show_instruction(self, text, poll_keys, poll_ms, error_message, width=300):
+        # Shared by screen picking and region watch: poll_keys(label, close) runs
+        # every poll_ms and returns True to keep polling
+        self.is_picking = True
+        
+        # Create a small toplevel window for instructions
+        instruction = ctk.CTkToplevel()
+        instruction.geometry(f"{width}x150")
+        instruction.title("Fairy Color Picker")
+        instruction.attributes('-topmost', True)
+        
+        # Center the instruction window
+        screen_width = instruction.winfo_screenwidth()
+        screen_height = instruction.winfo_screenheight()
+        x = (screen_width - width) // 2
+        y = (screen_height - 150) // 2
+        instruction.geometry(f"{width}x150+{x}+{y}")
+        
+        label = ctk.CTkLabel(instruction, text=text)
+        label.pack(pady=20)
+        
+        def close_instruction():
+            if instruction.winfo_exists():
+                instruction.destroy()
+            self.is_picking = False
+        
+        instruction.protocol('WM_DELETE_WINDOW', close_instruction)
+        
+        def check_keys():
+            # Later ticks run from after(), outside any caller's try
+            try:
+                if instruction.winfo_exists() and poll_keys(label, close_instruction):
+                    instruction.after(poll_ms, check_keys)
+            except Exception as e:
+                close_instruction()
+                self.show_error(f"{error_message}:\n{str(e)}")
+        
+        check_keys()
+
     def pick_color_from_screen(self):
         try:
             import pyautogui
@@ -189,24 +289,7 @@ class ColorPicker(ctk.CTk):
             # Store current window state
             self.was_in_tray = self.is_minimized
             
-            # Create a small toplevel window for instructions
-            instruction = ctk.CTkToplevel()
-            instruction.geometry("300x150")
-            instruction.title("Fairy Color Picker")
-            instruction.attributes('-topmost', True)
-            
-            # Center the instruction window
-            screen_width = instruction.winfo_screenwidth()
-            screen_height = instruction.winfo_screenheight()
-            x = (screen_width - 300) // 2
-            y = (screen_height - 150) // 2
-            instruction.geometry(f"300x150+{x}+{y}")
-            
-            label = ctk.CTkLabel(instruction, 
-                text="Move mouse to desired color and press Space.\nHold Shift for averaged sampling.\nPress Esc to cancel.")
-            label.pack(pady=20)
-            
-            def check_keys():
+            def poll_keys(label, close_instruction):
                 if keyboard.is_pressed('space'):
                     x, y = pyautogui.position()
                     
@@ -236,22 +319,26 @@ class ColorPicker(ctk.CTk):
                     self.green_var.set(enhanced_color[1])
                     self.blue_var.set(enhanced_color[2])
                     self.update_color()
-                    instruction.destroy()
+                    close_instruction()
                     # Always show window after picking color
                     self.show_window()
-                elif keyboard.is_pressed('escape'):
-                    instruction.destroy()
+                    return False
+                if keyboard.is_pressed('escape'):
+                    close_instruction()
                     # Return to previous state
                     if self.was_in_tray:
                         self.hide_window()
                     else:
                         self.show_window()
-                else:
-                    instruction.after(100, check_keys)
+                    return False
+                return True
             
-            check_keys()
+            self.show_instruction(
+                "Move mouse to desired color and press Space.\nHold Shift for averaged sampling.\nPress Esc to cancel.",
+                poll_keys, 100, "Error picking color")
         
         except Exception as e:
+            self.is_picking = False
             error_window = ctk.CTkToplevel()
             error_window.geometry("300x100")
             error_window.title("Error")
@@ -278,6 +365,80 @@ class ColorPicker(ctk.CTk):
             
             error_window.after(3000, close_error)  # Close error after 3 seconds
 
+    def start_region_watch(self):
+        if self.is_picking:
+            return
+        try:
+            import pyautogui
+            
+            state = {'corner': None, 'released': False}
+            
+            def poll_keys(label, close_instruction):
+                if keyboard.is_pressed('escape'):
+                    close_instruction()
+                    return False
+                if state['corner'] is None:
+                    if keyboard.is_pressed('space'):
+                        state['corner'] = pyautogui.position()
+                        label.configure(text="Press Space at the opposite corner,\n"
+                                             "or Enter to watch this pixel.")
+                elif not state['released']:
+                    # Wait for Space to be released before accepting the second corner
+                    state['released'] = not keyboard.is_pressed('space')
+                elif keyboard.is_pressed('space') or keyboard.is_pressed('enter'):
+                    x1, y1 = state['corner']
+                    x2, y2 = pyautogui.position() if keyboard.is_pressed('space') else state['corner']
+                    close_instruction()
+                    bbox = (min(x1, x2), min(y1, y2), max(x1, x2) + 1, max(y1, y2) + 1)
+                    self.watch_region(bbox)
+                    return False
+                return True
+            
+            self.show_instruction(
+                "Move mouse to the first corner and press Space.\n"
+                "Press Space at the opposite corner to watch an area,\n"
+                "or Enter to watch a single pixel.\nPress Esc to cancel.",
+                poll_keys, 50, "Error starting region watch", width=340)
+        
+        except Exception as e:
+            self.is_picking = False
+            self.show_error(f"Error starting region watch:\n{str(e)}")
+    
+    
+    def watch_region(self, bbox, source=None):
+        self.stop_region_watch()
+        # Events are tagged with their watcher so a replaced one can't log anything
+        watcher = RegionWatcher(source or ScreenFrameSource(bbox),
+                                lambda rgb, timestamp: self.on_watched_color_change(watcher, rgb, timestamp))
+        self.watcher = watcher
+        watcher.start()
+        self.icon.update_menu()
+    
+    def on_watched_color_change(self, watcher, rgb, timestamp):
+        # Called on the watcher thread
+        # Every change is kept in the buffer; the single flush command collapses
+        with self.watch_lock:
+            self.watch_events.append((watcher, rgb, timestamp))
+        self.commands.post("watch_flush", self.flush_watch_events)
+    
+    def flush_watch_events(self):
+        with self.watch_lock:
+            events, self.watch_events = self.watch_events, []
+        # Drop changes from a watcher that was stopped or replaced since they were posted
+        events = [(rgb, timestamp) for watcher, rgb, timestamp in events if watcher is self.watcher]
+        if not events:
+            return
+        for rgb, timestamp in events:
+            self.insert_history_entry(rgb, timestamp)
+        self.save_history()
+        self.update_history_display()
+    
+    def stop_region_watch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+            self.icon.update_menu()
+    
     def show_window(self):
         if self.is_minimized:
             self.deiconify()
@@ -301,6 +462,7 @@ class ColorPicker(ctk.CTk):
         self.hide_window()
 
     def quit_app(self):
+        self.stop_region_watch()
         self.icon.stop()
         self.quit()
 
@@ -418,6 +580,10 @@ class ColorPicker(ctk.CTk):
                                               command=self.copy_values, width=70)
         self.copy_values_button.grid(row=0, column=2, padx=5, pady=5)
         
+        self.copy_css_button = ctk.CTkButton(self.copy_frame, text="Copy CSS",
+                                           command=self.copy_css, width=70)
+        self.copy_css_button.grid(row=0, column=3, padx=5, pady=5)
+        
         # Save to history button
         self.save_button = ctk.CTkButton(self.sliders_frame, text="Save to History",
                                        command=self.save_to_history)
@@ -439,6 +605,18 @@ class ColorPicker(ctk.CTk):
                                          command=lambda: self.change_view_mode("grid"))
         self.grid_view_btn.pack(side="left", padx=5)
         
+        self.merge_similar_btn = ctk.CTkButton(self.view_mode_frame, text="Merge Similar",
+                                             command=self.merge_similar_history, width=110)
+        self.merge_similar_btn.pack(side="right", padx=5)
+        
+        self.gradient_btn = ctk.CTkButton(self.view_mode_frame, text="Gradient",
+                                        command=self.open_gradient_dialog, width=110)
+        self.gradient_btn.pack(side="right", padx=5)
+        
+        self.quantize_btn = ctk.CTkButton(self.view_mode_frame, text="Quantize Image",
+                                        command=self.open_quantize_dialog, width=110)
+        self.quantize_btn.pack(side="right", padx=5)
+        
         # History content frame
         self.history_content = ctk.CTkScrollableFrame(self.history_frame, height=200)
         self.history_content.pack(fill="both", expand=True, padx=10, pady=5)
@@ -506,7 +684,6 @@ class ColorPicker(ctk.CTk):
             self.shade_buttons[i].rgb_values = _
             
     def copy_shade(self, index):
-        hex_color = self.shade_buttons[index].hex_color
         r, g, b = self.shade_buttons[index].rgb_values
         
         # Update sliders and preview
@@ -516,46 +693,60 @@ class ColorPicker(ctk.CTk):
         self.update_color()
         
         # Copy hex color to clipboard
-        pyperclip.copy(hex_color)
+        self.copy_color('hex', (r, g, b))
+    
+    def copy_color(self, primary, rgb=None):
+        if rgb is None:
+            rgb = (self.red_var.get(), self.green_var.get(), self.blue_var.get())
+        self.clipboard_service.copy_formats(color_formats(*rgb), primary)
     
     def copy_hex(self):
-        hex_color = f"#{self.red_var.get():02x}{self.green_var.get():02x}{self.blue_var.get():02x}"
-        pyperclip.copy(hex_color)
+        self.copy_color('hex')
         
     def copy_rgb(self):
-        rgb = f"rgb({self.red_var.get()}, {self.green_var.get()}, {self.blue_var.get()})"
-        pyperclip.copy(rgb)
+        self.copy_color('rgb')
         
     def copy_values(self):
-        values = f"{self.red_var.get()}, {self.green_var.get()}, {self.blue_var.get()}"
-        pyperclip.copy(values)
+        self.copy_color('values')
+        
+    def copy_css(self):
+        self.copy_color('css')
         
     def save_to_history(self):
-        hex_color = f"#{self.red_var.get():02x}{self.green_var.get():02x}{self.blue_var.get():02x}"
+        self.add_to_history([self.red_var.get(), self.green_var.get(), self.blue_var.get()])
+    
+    def add_to_history(self, rgb, timestamp=None):
+        self.insert_history_entry(rgb, timestamp)
+        self.save_history()
+        self.update_history_display()
+    
+    def insert_history_entry(self, rgb, timestamp=None):
+        # Shared save path; callers adding many colors save and refresh once afterwards
+        rgb = [int(c) for c in rgb]
+        hex_color = f"#{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
+        timestamp = timestamp or datetime.now()
         color_data = {
             "color": hex_color,
-            "rgb": [self.red_var.get(), self.green_var.get(), self.blue_var.get()],
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "rgb": rgb,
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S")
         }
         
-        # Check if color exists in history
-        color_exists = False
-        for i, item in enumerate(self.history):
-            if item["color"] == hex_color:
-                # Update timestamp of existing color and move it to the end
-                self.history.pop(i)
-                self.history.append(color_data)
-                color_exists = True
-                break
-        
-        # Add new color if it doesn't exist
-        if not color_exists:
-            self.history.append(color_data)
-            
-        self.save_history()
-        self.update_history_display()
+        # In perceptual mode a close enough color counts as the same one
+        match = hex_color
+        if self.dedup_mode == 'perceptual':
+            match = self.get_history_index().merge(hex_color, rgb) or hex_color
+        
+        # Drop the existing entry so the color moves to the end with a new timestamp
+        positions = self.get_history_positions()
+        i = positions.find(match)
+        if i is not None:
+            positions.pop(i)
+        positions.append(color_data)
+        self.history_version += 1
         
     def load_history(self):
+        self.history_index = None
+        self.history_version += 1
         if os.path.exists(self.history_file):
             try:
                 with open(self.history_file, 'r') as f:
@@ -563,6 +754,59 @@ class ColorPicker(ctk.CTk):
                 self.update_history_display()
             except:
                 self.history = []
+    
+    def get_history_index(self):
+        if self.history_index is None or self.history_index.threshold != self.dedup_threshold:
+            self.history_index = LabGridIndex(self.dedup_threshold)
+            self.history_index.add_many([item["color"] for item in self.history],
+                                        [entry_rgb(item) for item in self.history])
+        return self.history_index
+    
+    def get_history_positions(self):
+        # Rebuild whenever self.history was replaced by a new list
+        if self.history_positions is None or self.history_positions.history is not self.history:
+            self.history_positions = HistoryPositions(self.history)
+        return self.history_positions
+    
+    def merge_similar_history(self):
+        # One-shot pass that keeps the newest color of each group of near-duplicates,
+        # computed off the UI thread on a snapshot of the history
+        if self.is_merging:
+            return
+        self.is_merging = True
+        self.merge_similar_btn.configure(state="disabled")
+        history, version, threshold = self.history, self.history_version, self.dedup_threshold
+        snapshot = list(history)
+        
+        def work():
+            try:
+                merged = collapse_near_duplicates(snapshot, threshold)
+            except Exception as e:
+                merged = e
+            self.commands.post("merge_done", self.finish_merge, history, version, merged)
+        
+        threading.Thread(target=work, daemon=True).start()
+    
+    def finish_merge(self, history, version, merged):
+        self.is_merging = False
+        self.merge_similar_btn.configure(state="normal")
+        if isinstance(merged, Exception):
+            self.show_error(f"Failed to merge similar colors: {str(merged)}")
+            return
+        if self.history is not history or self.history_version != version:
+            self.show_error("History changed while merging, please try again.")
+            return
+        self.history = merged
+        self.history_index = None
+        self.history_version += 1
+        self.save_history()
+        self.update_history_display()
+    
+    def toggle_perceptual_dedup(self):
+        self.dedup_mode = 'exact' if self.dedup_mode == 'perceptual' else 'perceptual'
+        self.history_index = None
+        self.icon.update_menu()
+        self.save_config()
                 
     def save_history(self):
         with open(self.history_file, 'w') as f:
@@ -592,7 +836,7 @@ class ColorPicker(ctk.CTk):
                 
                 # Copy button
                 copy_btn = ctk.CTkButton(color_frame, text="Copy", width=60,
-                                       command=lambda c=color_data["color"]: pyperclip.copy(c))
+                                       command=lambda rgb=color_data["rgb"]: self.copy_color('hex', rgb))
                 copy_btn.pack(side="right", padx=5)
         else:  # Grid view
             grid_frame = ctk.CTkFrame(self.history_content)
@@ -628,30 +872,211 @@ class ColorPicker(ctk.CTk):
                 
                 # Copy button
                 copy_btn = ctk.CTkButton(color_cell, text="Copy", width=60,
-                                       command=lambda c=color_data["color"]: pyperclip.copy(c))
+                                       command=lambda rgb=color_data["rgb"]: self.copy_color('hex', rgb))
                 copy_btn.pack(pady=2)
         
+    def open_gradient_dialog(self):
+        dialog = ctk.CTkToplevel(self)
+        dialog.title("Gradient")
+        dialog.geometry("520x300")
+        dialog.attributes('-topmost', True)
+        
+        # Default to the two most recent history colors
+        recent = [item["color"] for item in self.history[-2:]]
+        if len(recent) < 2:
+            recent = [f"#{self.red_var.get():02x}{self.green_var.get():02x}{self.blue_var.get():02x}", "#ffffff"]
+        colors_var = ctk.StringVar(value=" ".join(recent))
+        steps_var = ctk.StringVar(value="7")
+        space_var = ctk.StringVar(value="oklab")
+        dither_var = ctk.StringVar(value="blue-noise")
+        size_var = ctk.StringVar(value="7680x1080")
+        
+        colors_entry = ctk.CTkEntry(dialog, textvariable=colors_var,
+                                    placeholder_text="Stop colors, e.g. #FF0000 #0000FF")
+        colors_entry.pack(fill="x", padx=10, pady=(10, 5))
+        
+        options_frame = ctk.CTkFrame(dialog)
+        options_frame.pack(fill="x", padx=10, pady=5)
+        ctk.CTkLabel(options_frame, text="Steps:").pack(side="left", padx=5)
+        ctk.CTkEntry(options_frame, textvariable=steps_var, width=50).pack(side="left", padx=5)
+        ctk.CTkOptionMenu(options_frame, variable=space_var, values=GRADIENT_SPACES,
+                          width=90).pack(side="left", padx=5)
+        
+        preview_frame = ctk.CTkFrame(dialog, height=40)
+        preview_frame.pack(fill="x", padx=10, pady=5)
+        
+        def build_stops():
+            colors = [entry_rgb({"color": c}) for c in re.findall(r'#?([A-Fa-f0-9]{6})\b', colors_var.get())]
+            steps = int(steps_var.get())
+            if not colors or not 2 <= steps <= MAX_GRADIENT_STEPS:
+                raise ValueError(f"Enter at least one HEX color and 2 to {MAX_GRADIENT_STEPS} steps.")
+            return colors, gradient_stops(colors, steps, space_var.get())
+        
+        def preview():
+            for widget in preview_frame.winfo_children():
+                widget.destroy()
+            try:
+                _, stops = build_stops()
+            except ValueError as e:
+                self.show_error(str(e))
+                return
+            width = max(4, 500 // len(stops))
+            for r, g, b in stops:
+                cell = ctk.CTkFrame(preview_frame, width=width, height=30, corner_radius=0,
+                                    fg_color=f"#{r:02x}{g:02x}{b:02x}")
+                cell.pack(side="left", pady=5)
+        
+        def add_to_history():
+            try:
+                _, stops = build_stops()
+            except ValueError as e:
+                self.show_error(str(e))
+                return
+            # Feed every stop through the regular save path, then save once
+            for rgb in stops:
+                self.insert_history_entry(rgb)
+            self.save_history()
+            self.update_history_display()
+        
+        def export_image():
+            try:
+                colors, _ = build_stops()
+                width, height = (int(v) for v in size_var.get().lower().split("x"))
+            except ValueError:
+                self.show_error("Enter stop colors, steps and a size like 7680x1080.")
+                return
+            path = tkinter.filedialog.asksaveasfilename(parent=dialog, defaultextension=".png",
+                                                        filetypes=[("PNG image", "*.png")])
+            if not path:
+                return
+            space, dither = space_var.get(), dither_var.get()
+            
+            def run_export():
+                try:
+                    export_gradient_image(path, colors, width, height, space, dither)
+                except Exception as e:
+                    self.commands.post(("gradient_error", path), self.show_error,
+                                       f"Failed to export gradient: {str(e)}")
+                else:
+                    self.commands.post(("gradient_done", path), self.show_message,
+                                       f"Gradient exported to {os.path.basename(path)}")
+            
+            # Large banners take a moment, keep the UI responsive
+            threading.Thread(target=run_export, daemon=True).start()
+        
+        export_frame = ctk.CTkFrame(dialog)
+        export_frame.pack(fill="x", padx=10, pady=5)
+        ctk.CTkLabel(export_frame, text="Image:").pack(side="left", padx=5)
+        ctk.CTkEntry(export_frame, textvariable=size_var, width=90).pack(side="left", padx=5)
+        ctk.CTkOptionMenu(export_frame, variable=dither_var, values=["none", "ordered", "blue-noise"],
+                          width=100).pack(side="left", padx=5)
+        
+        buttons_frame = ctk.CTkFrame(dialog)
+        buttons_frame.pack(pady=10)
+        ctk.CTkButton(buttons_frame, text="Preview", command=preview, width=100).grid(row=0, column=0, padx=5)
+        ctk.CTkButton(buttons_frame, text="Add to History", command=add_to_history,
+                      width=100).grid(row=0, column=1, padx=5)
+        ctk.CTkButton(buttons_frame, text="Export Image", command=export_image,
+                      width=100).grid(row=0, column=2, padx=5)
+        
+        preview()
+        
+    def open_quantize_dialog(self):
+        palette = [entry_rgb(item) for item in self.history]
+        if not palette:
+            self.show_error("Save some colors to history first, they are used as the palette.")
+            return
+        path = tkinter.filedialog.askopenfilename(parent=self, filetypes=[
+            ("Images", "*.png *.jpg *.jpeg *.bmp *.gif *.webp"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            source = np.asarray(Image.open(path).convert('RGB'))
+        except Exception as e:
+            self.show_error(f"Failed to open image: {str(e)}")
+            return
+        
+        dialog = ctk.CTkToplevel(self)
+        dialog.title("Quantize Image")
+        dialog.geometry("660x520")
+        dialog.attributes('-topmost', True)
+        
+        # 'run' numbers quantize passes; only the latest one may show its result
+        result = {'image': None, 'run': 0}
+        dither_var = ctk.BooleanVar(value=False)
+        
+        # Fit the preview inside the dialog, keeping the aspect ratio
+        height, width = source.shape[:2]
+        scale = min(640 / width, 420 / height, 1.0)
+        preview_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        preview = ctk.CTkLabel(dialog, text="Quantizing...", width=640, height=420)
+        preview.pack(padx=10, pady=10)
+        
+        def show_result(run, image):
+            if run != result['run'] or not dialog.winfo_exists():
+                return
+            result['image'] = image
+            preview.configure(image=ctk.CTkImage(light_image=image, dark_image=image, size=preview_size), text="")
+        
+        def show_failure(run, message):
+            if run == result['run']:
+                self.show_error(message)
+        
+        def run_quantize():
+            result['run'] += 1
+            result['image'] = None
+            run = result['run']
+            preview.configure(text="Quantizing...")
+            dither = dither_var.get()
+            
+            def work():
+                # Queue keys are unique per dialog and run, so results never replace each other
+                key = (id(dialog), run)
+                try:
+                    # The lookup table is cached per palette, so re-runs only remap pixels
+                    image = Image.fromarray(PaletteQuantizer(palette).remap(source, dither).astype(np.uint8))
+                except Exception as e:
+                    if run == result['run']:
+                        self.commands.post(("quantize_error",) + key, show_failure, run,
+                                           f"Failed to quantize image: {str(e)}")
+                    return
+                # A newer run was started meanwhile; its result is the one to show
+                if run == result['run']:
+                    self.commands.post(("quantize_done",) + key, show_result, run, image)
+            
+            threading.Thread(target=work, daemon=True).start()
+        
+        def save_result():
+            if result['image'] is None:
+                return
+            target = tkinter.filedialog.asksaveasfilename(parent=dialog, defaultextension=".png",
+                                                          filetypes=[("PNG image", "*.png")])
+            if target:
+                result['image'].save(target)
+        
+        controls = ctk.CTkFrame(dialog)
+        controls.pack(pady=5)
+        ctk.CTkCheckBox(controls, text="Error diffusion", variable=dither_var,
+                        command=run_quantize).grid(row=0, column=0, padx=5)
+        ctk.CTkButton(controls, text="Save As", command=save_result, width=100).grid(row=0, column=1, padx=5)
+        
+        run_quantize()
+        
     def change_view_mode(self, mode):
         self.view_mode.set(mode)
         self.update_history_display()
         
     def clear_history(self):
         self.history = []
+        self.history_index = None
+        self.history_version += 1
         self.save_history()
         self.update_history_display()
         
     def set_initial_color(self):
         if self.history:
             # Use the last color from history
-            last_color = self.history[-1]
-            if 'rgb' in last_color:
-                r, g, b = last_color['rgb']
-            else:
-                # Convert hex to rgb for older history entries
-                hex_color = last_color['color'].lstrip('#')
-                r = int(hex_color[0:2], 16)
-                g = int(hex_color[2:4], 16)
-                b = int(hex_color[4:6], 16)
+            r, g, b = entry_rgb(self.history[-1])
         else:
             # Generate random color
             r = random.randint(0, 255)
@@ -704,25 +1129,34 @@ class ColorPicker(ctk.CTk):
         self.update_color()
     
     def show_error(self, message):
-        error_window = ctk.CTkToplevel(self)
-        error_window.geometry("400x100")
-        error_window.title("Error")
-        error_window.attributes('-topmost', True)
+        self.show_message(message, "Error")
+    
+    def show_message(self, message, title="Fairy Color Picker"):
+        message_window = ctk.CTkToplevel(self)
+        message_window.geometry("400x100")
+        message_window.title(title)
+        message_window.attributes('-topmost', True)
         
-        error_label = ctk.CTkLabel(error_window, text=message, wraplength=350)
-        error_label.pack(pady=20)
+        message_label = ctk.CTkLabel(message_window, text=message, wraplength=350)
+        message_label.pack(pady=20)
         
-        def close_error():
-            error_window.destroy()
+        def close_message():
+            message_window.destroy()
         
-        error_window.after(3000, close_error)  # Auto-close after 3 seconds
+        message_window.after(3000, close_message)  # Auto-close after 3 seconds
 
     def load_config(self):
+        # History dedup: 'exact' (same HEX) or 'perceptual' (within a ΔE2000 threshold)
+        self.dedup_mode = 'exact'
+        self.dedup_threshold = 2.3
         try:
             if os.path.exists(self.config_file):
                 with open(self.config_file, 'r') as f:
                     config = json.load(f)
                     self.shortcut = config.get('shortcut', 'ctrl+shift+p')
+                    if config.get('dedup_mode') in ('exact', 'perceptual'):
+                        self.dedup_mode = config['dedup_mode']
+                    self.dedup_threshold = self.parse_dedup_threshold(config.get('dedup_threshold'))
             else:
                 self.shortcut = 'ctrl+shift+p'  # Default shortcut
                 self.save_config()
@@ -730,10 +1164,21 @@ class ColorPicker(ctk.CTk):
             self.shortcut = 'ctrl+shift+p'  # Fallback to default if any error
             self.save_config()
 
+    def parse_dedup_threshold(self, value):
+        # Checked on its own so a bad threshold never resets the saved shortcut;
+        # the Lab grid index needs a positive, finite cell size
+        try:
+            threshold = float(value)
+        except (TypeError, ValueError):
+            return 2.3
+        return threshold if 0 < threshold < float('inf') else 2.3
+
     def save_config(self):
         try:
             config = {
-                'shortcut': self.shortcut
+                'shortcut': self.shortcut,
+                'dedup_mode': self.dedup_mode,
+                'dedup_threshold': self.dedup_threshold
             }
             with open(self.config_file, 'w') as f:
                 json.dump(config, f)
@@ -749,7 +1194,7 @@ class ColorPicker(ctk.CTk):
                 pass
             # Set new shortcut
             self.shortcut = new_shortcut
-            keyboard.add_hotkey(self.shortcut, self.start_color_pick)
+            keyboard.add_hotkey(self.shortcut, self.post_command("pick", self.start_color_pick))
             # Update the icon to refresh the menu state
             self.icon.update_menu()
             # Save the new shortcut to config
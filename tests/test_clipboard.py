@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+from color_core import ClipboardService, MemoryClipboardBackend, color_formats
+
+class BlockingMemoryBackend(MemoryClipboardBackend):
+    """Records every publish; behaves like a helper-process backend that runs on the worker"""
+    blocking = True
+
+    def __init__(self, gate=None):
+        super().__init__()
+        self.gate = gate
+        self.entered = threading.Event()
+        self.published = []
+
+    def publish(self, text, formats):
+        self.entered.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        super().publish(text, formats)
+        self.published.append(text)
+
+class FailingBackend:
+    blocking = False
+
+    def publish(self, text, formats):
+        raise RuntimeError("no display")
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+def test_color_formats():
+    assert color_formats(255, 0, 16) == {
+        'hex': '#ff0010',
+        'rgb': 'rgb(255, 0, 16)',
+        'values': '255, 0, 16',
+        'css': '--picked-color: #ff0010;'
+    }
+
+def test_copy_publishes_every_format():
+    backend = MemoryClipboardBackend()
+    service = ClipboardService(backend)
+    formats = color_formats(10, 20, 30)
+    service.copy_formats(formats, 'rgb')
+    assert backend.text == 'rgb(10, 20, 30)'
+    assert backend.formats == formats
+    assert service.text == 'rgb(10, 20, 30)'
+
+def test_copy_latency_is_recorded():
+    service = ClipboardService(MemoryClipboardBackend())
+    for value in range(3):
+        service.copy_formats(color_formats(value, value, value))
+    stats = service.latency.stats()
+    assert stats['count'] == 3
+    assert 0 <= stats['min_ms'] <= stats['mean_ms'] <= stats['max_ms']
+    assert stats['max_ms'] < 1000
+
+def test_failing_backend_switches_to_fallback():
+    fallback = BlockingMemoryBackend()
+    service = ClipboardService(FailingBackend(), fallback=fallback)
+    service.copy_formats(color_formats(1, 2, 3))
+    assert service.backend is fallback
+    assert service.fallback is None
+    assert wait_for(lambda: fallback.published == ['#010203'])
+    assert fallback.formats['css'] == '--picked-color: #010203;'
+    
+    # Later copies go straight to the fallback
+    service.copy_formats(color_formats(4, 5, 6))
+    assert wait_for(lambda: fallback.published == ['#010203', '#040506'])
+    assert service.latency.stats()['count'] == 2
+
+def test_failing_backend_without_fallback_raises():
+    service = ClipboardService(FailingBackend())
+    with pytest.raises(RuntimeError):
+        service.copy('#000000')
+
+def test_pending_worker_copies_collapse_to_latest():
+    gate = threading.Event()
+    backend = BlockingMemoryBackend(gate)
+    service = ClipboardService(backend)
+    service.copy('#000001')
+    assert backend.entered.wait(5)
+    
+    # The worker is busy with the first copy; only the newest of these should follow it
+    for text in ('#000002', '#000003', '#000004'):
+        service.copy(text)
+    gate.set()
+    assert wait_for(lambda: len(backend.published) == 2)
+    time.sleep(0.05)
+    assert backend.published == ['#000001', '#000004']
+    assert backend.text == '#000004'
+    assert service.latency.stats()['count'] == 2
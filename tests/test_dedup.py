@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from color_core import (BLUE_HUES, CHROMA_SPREAD, CHROMA_SPREAD_OUTSIDE_BLUE, LIGHTNESS_SPREAD,
+                        HistoryPositions, LabGridIndex, chroma_spread, collapse_near_duplicates,
+                        delta_e_2000, lab_grid_coords, srgb_to_lab)
+
+THRESHOLDS = [0.5, 1.0, 2.3, 5.0]
+
+def random_colors(rng, count, blue_share=0.3):
+    # Oversample the blue hues, where ΔE2000's rotation term needs the widest reach
+    colors = rng.integers(0, 256, (count, 3))
+    blue = rng.random(count) < blue_share
+    colors[blue, 2] = rng.integers(128, 256, blue.sum())
+    colors[blue, :2] = np.minimum(colors[blue, :2], colors[blue, 2:3])
+    return colors
+
+def nearby(rng, colors, spread):
+    return np.clip(colors + rng.integers(-spread, spread + 1, colors.shape), 0, 255)
+
+def test_delta_e_2000_reference_values():
+    # Pairs from Sharma, Wu and Dalal's CIEDE2000 test data
+    pairs = [
+        ((50.0, 2.6772, -79.7751), (50.0, 0.0, -82.7485), 2.0425),
+        ((50.0, 3.1571, -77.2803), (50.0, 0.0, -82.7485), 2.8615),
+        ((50.0, -1.3802, -84.2814), (50.0, 0.0, -82.7485), 1.0000),
+        ((50.0, 2.5, 0.0), (50.0, 3.1736, 0.5854), 1.0000),
+        ((50.0, 2.5, 0.0), (73.0, 25.0, -18.0), 27.1492),
+        ((50.0, 2.5, 0.0), (61.0, -5.0, 29.0), 22.8977),
+        ((2.0776, 0.0795, -1.1350), (0.9033, -0.0636, -0.5514), 0.9082),
+    ]
+    lab1, lab2, expected = (np.array(column) for column in zip(*pairs))
+    assert np.allclose(delta_e_2000(lab1, lab2), expected, atol=1e-4)
+    assert np.allclose(delta_e_2000(lab2, lab1), expected, atol=1e-4)
+
+def test_grid_reach_covers_every_close_pair():
+    # The grid only scans LIGHTNESS_SPREAD / chroma_spread times the threshold
+    # around a query; every sRGB pair within the threshold has to fit in there
+    rng = np.random.default_rng(1)
+    base = random_colors(rng, 200000)
+    other = nearby(rng, base, 6)
+    lab1, lab2 = srgb_to_lab(base), srgb_to_lab(other)
+    distance = delta_e_2000(lab1, lab2)
+    close = (distance > 0) & (distance <= 5.0)
+    assert close.sum() > 10000
+    lab1, lab2, distance = lab1[close], lab2[close], distance[close]
+    
+    assert np.all(np.abs(lab1[:, 0] - lab2[:, 0]) <= distance * LIGHTNESS_SPREAD)
+    offsets = lab_grid_coords(lab2) - lab_grid_coords(lab1)
+    ab_distance = np.hypot(offsets[:, 1], offsets[:, 2])
+    assert np.all(ab_distance <= distance * chroma_spread(lab1))
+    assert np.all(ab_distance <= distance * CHROMA_SPREAD)
+
+def test_chroma_spread_uses_the_blue_band():
+    hues = np.radians([100.0, BLUE_HUES[0] + 1, 275.0, BLUE_HUES[1] - 1, 355.0])
+    lab = np.stack([np.full(5, 50.0), 30 * np.cos(hues), 30 * np.sin(hues)], axis=-1)
+    outside, blue = CHROMA_SPREAD_OUTSIDE_BLUE, CHROMA_SPREAD
+    assert chroma_spread(lab).tolist() == [outside, blue, blue, blue, outside]
+
+@pytest.mark.parametrize("threshold", THRESHOLDS)
+def test_find_matches_brute_force(threshold):
+    rng = np.random.default_rng(int(threshold * 10))
+    colors = random_colors(rng, 2000)
+    lab = srgb_to_lab(colors)
+    index = LabGridIndex(threshold)
+    index.add_many(range(len(colors)), colors)
+    
+    queries = nearby(rng, colors[rng.integers(0, len(colors), 800)], int(3 * threshold) + 2)
+    distances = delta_e_2000(srgb_to_lab(queries)[:, None, :], lab[None, :, :])
+    for query, row in zip(queries, distances):
+        key = index.find(query)
+        if row.min() > threshold:
+            assert key is None
+        else:
+            assert key is not None and row[key] == row.min()
+
+def test_merge_replaces_the_closest_entry():
+    index = LabGridIndex(2.3)
+    index.add('#808080', (128, 128, 128))
+    index.add('#ff0000', (255, 0, 0))
+    assert index.merge('#818181', (129, 129, 129)) == '#808080'
+    assert len(index) == 2
+    assert index.find((128, 128, 128)) == '#818181'
+    assert index.merge('#00ff00', (0, 255, 0)) is None
+    assert len(index) == 3
+    index.remove('#ff0000')
+    assert index.find((255, 0, 0)) is None
+
+def test_invalid_threshold_is_rejected():
+    for threshold in (0, -1.0, float('inf'), float('nan')):
+        with pytest.raises(ValueError):
+            LabGridIndex(threshold)
+
+def brute_force_collapse(history, threshold):
+    rgb = np.array([item['rgb'] for item in history])
+    distances = delta_e_2000(srgb_to_lab(rgb)[:, None, :], srgb_to_lab(rgb)[None, :, :])
+    keep = np.ones(len(history), dtype=bool)
+    for i in range(len(history) - 1, -1, -1):
+        newer = np.arange(i + 1, len(history))
+        if np.any(keep[newer] & (distances[i, newer] <= threshold)):
+            keep[i] = False
+    return [item for item, kept in zip(history, keep) if kept]
+
+@pytest.mark.parametrize("threshold", [1.0, 2.3, 5.0])
+def test_collapse_matches_brute_force_greedy(threshold):
+    rng = np.random.default_rng(3)
+    # Clusters of near-duplicates around a few hundred centers
+    centers = random_colors(rng, 150)
+    colors = nearby(rng, centers[rng.integers(0, len(centers), 1200)], 4)
+    history = [{'color': f"#{r:02x}{g:02x}{b:02x}", 'rgb': [int(r), int(g), int(b)]}
+               for r, g, b in colors]
+    collapsed = collapse_near_duplicates(history, threshold, budget=2000)
+    assert len(collapsed) < len(history)
+    assert collapsed == brute_force_collapse(history, threshold)
+
+def test_history_positions_track_pops_and_appends():
+    history = [{'color': f"#0000{i:02x}"} for i in range(10)]
+    positions = HistoryPositions(history, slack=3)
+    for hex_color in ('#000002', '#000007', '#000000', '#000009', '#000005'):
+        positions.pop(positions.find(hex_color))
+    positions.append({'color': '#000002'})
+    for i, item in enumerate(history):
+        assert positions.find(item['color']) == i
+    assert positions.find('#000007') is None
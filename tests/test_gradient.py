@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from color_core import (GRADIENT_SPACES, export_gradient_image, gradient_colors, gradient_row_blocks,
+                        gradient_stops)
+
+@pytest.mark.parametrize("space", GRADIENT_SPACES)
+def test_gradient_stops_start_and_end_on_the_stop_colors(space):
+    colors = [(255, 0, 0), (0, 128, 255), (20, 200, 40)]
+    stops = gradient_stops(colors, 9, space)
+    assert len(stops) == 9
+    assert stops[0] == colors[0]
+    assert stops[4] == colors[1]
+    assert stops[-1] == colors[2]
+
+def test_hsv_takes_the_shortest_hue_arc():
+    # Red to magenta goes through pink, not through green and blue
+    middle = gradient_stops([(255, 0, 0), (255, 0, 255)], 3, 'hsv')[1]
+    assert middle == (255, 0, 128)
+
+@pytest.mark.parametrize("dither", ['ordered', 'blue-noise'])
+def test_dithering_keeps_local_averages(dither):
+    colors = [(0, 0, 0), (40, 40, 40)]
+    width = 640
+    exact = gradient_colors(colors, np.linspace(0.0, 1.0, width), 'srgb')
+    image = np.concatenate(list(gradient_row_blocks(colors, width, 128, 'srgb', dither, block_rows=48)))
+    assert image.shape == (128, width, 3)
+    # Averaged over 8-column strips; plain rounding is off by almost 0.3 levels here
+    strips = image.mean(axis=0).reshape(-1, 8, 3).mean(axis=1)
+    assert np.abs(strips - exact.reshape(-1, 8, 3).mean(axis=1)).max() < 0.1
+
+def test_export_writes_png_through_a_temporary_file(tmp_path):
+    path = tmp_path / "banner.png"
+    export_gradient_image(str(path), [(0, 0, 0), (255, 255, 255)], width=300, height=70,
+                          space='srgb', dither='ordered', block_rows=32)
+    assert os.listdir(tmp_path) == ["banner.png"]
+    with Image.open(path) as image:
+        assert image.size == (300, 70)
+        pixels = np.asarray(image.convert('RGB'))
+    assert pixels[:, 0].max() == 0
+    assert pixels[:, -1].min() == 255
+
+def test_failed_export_keeps_the_existing_file(tmp_path):
+    path = tmp_path / "banner.png"
+    path.write_bytes(b"previous export")
+    with pytest.raises(ValueError):
+        export_gradient_image(str(path), [(0, 0, 0), (255, 255, 255)], width=300, height=70,
+                              dither='no-such-method')
+    assert os.listdir(tmp_path) == ["banner.png"]
+    assert path.read_bytes() == b"previous export"
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from color_core import PaletteQuantizer, build_palette_lut, nearest_palette_index
+
+def floyd_steinberg_reference(quantizer, image):
+    # Plain scanline Floyd-Steinberg, one pixel at a time
+    work = np.asarray(image, dtype=np.float64).copy()
+    height, width = work.shape[:2]
+    palette = quantizer.palette.astype(np.float64)
+    result = np.empty((height, width), dtype=np.intp)
+    for y in range(height):
+        for x in range(width):
+            value = np.clip(work[y, x], 0, 255)
+            result[y, x] = quantizer.lookup(np.rint(value).astype(np.uint8)[None])[0]
+            error = value - palette[result[y, x]]
+            if x + 1 < width:
+                work[y, x + 1] += error * 7 / 16
+            if y + 1 < height:
+                if x > 0:
+                    work[y + 1, x - 1] += error * 3 / 16
+                work[y + 1, x] += error * 5 / 16
+                if x + 1 < width:
+                    work[y + 1, x + 1] += error * 1 / 16
+    return result
+
+def test_lookup_matches_brute_force_nearest_color():
+    rng = np.random.default_rng(0)
+    quantizer = PaletteQuantizer(rng.integers(0, 256, (40, 3)))
+    pixels = rng.integers(0, 256, (50000, 3)).astype(np.uint8)
+    expected = nearest_palette_index(pixels, quantizer.palette)
+    found = quantizer.lookup(pixels)
+    # Ties may pick either color, so compare distances rather than indices
+    distance = lambda index: ((pixels.astype(int) - quantizer.palette[index].astype(int)) ** 2).sum(axis=1)
+    assert np.array_equal(distance(found), distance(expected))
+
+def test_lookup_table_is_cached_per_palette():
+    palette = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+    first = PaletteQuantizer(palette)
+    second = PaletteQuantizer(list(reversed(palette)))
+    assert first.lut is second.lut
+    assert PaletteQuantizer(palette + [(0, 0, 255)]).lut is not first.lut
+
+@pytest.mark.parametrize("shape, chunk_rows", [((40, 37), 3), ((9, 1), 2), ((1, 23), 64), ((30, 30), 64)])
+def test_error_diffusion_matches_scanline_floyd_steinberg(shape, chunk_rows):
+    rng = np.random.default_rng(1)
+    quantizer = PaletteQuantizer(rng.integers(0, 256, (24, 3)))
+    image = rng.integers(0, 256, shape + (3,)).astype(np.uint8)
+    expected = floyd_steinberg_reference(quantizer, image)
+    assert np.array_equal(quantizer.indices(image, dither=True, chunk_rows=chunk_rows), expected)
+
+def test_error_diffusion_on_flat_gray_has_no_stripes():
+    quantizer = PaletteQuantizer([(0, 0, 0), (255, 255, 255)])
+    image = np.full((12, 12, 3), 100, dtype=np.uint8)
+    result = quantizer.remap(image, dither=True)[..., 0].astype(float)
+    # Neither rows nor columns collapse to a single value
+    assert np.all(result.min(axis=1) != result.max(axis=1))
+    assert np.all(result.min(axis=0) != result.max(axis=0))
+    assert abs(result.mean() - 100) < 10
+
+def test_error_diffusion_follows_a_gradient():
+    quantizer = PaletteQuantizer([(0, 0, 0), (85, 85, 85), (170, 170, 170), (255, 255, 255)])
+    ramp = np.linspace(0, 255, 256)
+    image = np.repeat(np.broadcast_to(ramp[None, :, None], (64, 256, 1)), 3, axis=2).astype(np.uint8)
+    plain = quantizer.remap(image)[..., 0].mean(axis=0)
+    dithered = quantizer.remap(image, dither=True)[..., 0].mean(axis=0)
+    # Column averages track the ramp instead of stepping between palette levels
+    assert np.abs(plain - ramp).max() > 40
+    assert np.abs(dithered - ramp).max() < 12
+    assert np.abs(dithered - ramp).mean() < 3
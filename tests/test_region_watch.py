@@ -0,0 +1,95 @@
+from datetime import datetime
+import time
+
+import numpy as np
+import pytest
+
+from color_core import RegionWatcher, SyntheticFrameSource
+
+def frame(rgb, size=(4, 4)):
+    return np.broadcast_to(np.array(rgb, dtype=np.uint8), size + (3,)).copy()
+
+def make_watcher(frames, **options):
+    changes = []
+    watcher = RegionWatcher(SyntheticFrameSource(frames), lambda rgb, timestamp: changes.append((rgb, timestamp)),
+                            **options)
+    return watcher, changes
+
+def test_baseline_capture_is_not_a_change():
+    watcher, changes = make_watcher([frame((10, 20, 30))])
+    assert watcher.step() is False
+    assert changes == []
+    assert watcher.changes == 0
+    assert watcher.color.tolist() == [10, 20, 30]
+
+def test_change_above_threshold_is_reported_and_resets_interval():
+    watcher, changes = make_watcher([frame((10, 20, 30)), frame((200, 20, 30))], max_interval=2.0)
+    watcher.step()
+    watcher.interval = 2.0
+    assert watcher.step() is True
+    assert watcher.interval == watcher.min_interval
+    assert [rgb for rgb, _ in changes] == [(200, 20, 30)]
+    assert isinstance(changes[0][1], datetime)
+
+def test_area_is_averaged_before_comparing():
+    half = frame((0, 0, 0))
+    half[:, 2:] = 255
+    watcher, changes = make_watcher([frame((0, 0, 0)), half])
+    watcher.step()
+    watcher.step()
+    assert [rgb for rgb, _ in changes] == [(128, 128, 128)]
+
+def test_change_below_threshold_is_ignored_without_backing_off():
+    watcher, changes = make_watcher([frame((100, 100, 100)), frame((101, 100, 100))], backoff=2.0)
+    watcher.step()
+    interval = watcher.interval
+    assert watcher.step() is False
+    assert changes == []
+    assert watcher.interval == interval
+
+def test_static_frames_back_off_up_to_max_interval():
+    watcher, changes = make_watcher([frame((50, 60, 70))], min_interval=0.1, max_interval=1.0, backoff=2.0)
+    intervals = []
+    for _ in range(6):
+        watcher.step()
+        intervals.append(watcher.interval)
+    # The first capture is the baseline; identical frames after it double the interval
+    assert intervals == pytest.approx([0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+    assert changes == []
+
+def test_stopped_watcher_does_not_report():
+    watcher, changes = make_watcher([frame((0, 0, 0)), frame((255, 255, 255))])
+    watcher.step()
+    watcher.stop()
+    watcher.step()
+    assert changes == []
+
+def test_stats_after_steps():
+    frames = [frame((0, 0, 0)), frame((0, 0, 0)), frame((0, 0, 255)), frame((0, 0, 255))]
+    watcher, changes = make_watcher(frames, min_interval=0.1, max_interval=2.0, backoff=1.5)
+    for _ in frames:
+        watcher.step()
+    stats = watcher.stats()
+    assert stats['samples'] == 4
+    assert stats['changes'] == 1
+    assert stats['interval_ms'] == pytest.approx(150.0)
+    # Not started, so there is no wall time to relate CPU time or intervals to
+    assert stats['cpu_percent'] == 0.0
+    assert stats['mean_interval_ms'] == 0.0
+
+def test_stats_while_running():
+    frames = [frame((0, 0, 0))] * 5 + [frame((255, 0, 0))]
+    watcher, changes = make_watcher(frames, min_interval=0.01, max_interval=0.02)
+    watcher.start()
+    deadline = time.monotonic() + 5
+    while watcher.samples < 10 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    watcher.stop()
+    watcher.thread.join(5)
+    stats = watcher.stats()
+    assert stats['samples'] >= 10
+    assert stats['changes'] == 1
+    assert [rgb for rgb, _ in changes] == [(255, 0, 0)]
+    assert 0.0 <= stats['cpu_percent'] <= 100.0
+    assert 0 < stats['min_interval_ms'] <= stats['mean_interval_ms'] <= stats['max_interval_ms']
+    assert watcher.last_error is None